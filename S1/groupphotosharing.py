@@ -3,7 +3,7 @@
     Group Photo Sharing
     ~~~~~~~~~~~~~~~~~~~
 
-    A Photo sharing application that creates a image montage employing 
+    A Photo sharing application that creates a image montage employing
     the 2 phase commit protocol
 """
 
@@ -13,8 +13,16 @@ import shelve
 import shutil
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import json
 import threading
+import filecmp
+import uuid
+import heapq
+import itertools
+import traceback
+from collections import OrderedDict
 from PIL import Image
 from StringIO import StringIO
 from sqlite3 import dbapi2 as sqlite3
@@ -24,11 +32,18 @@ from flask import Flask, request, session, g, redirect, url_for, abort, \
 from werkzeug.utils import secure_filename
 """from threading import Timer"""
 
+EVENTS_FOLDER = os.path.realpath('.') + '/events/'
+STAGING_FOLDER = os.path.realpath('.') + '/staging/'
+# Where the single-event layout kept its files, see migrate_legacy_folders
 UPLOAD_FOLDER = os.path.realpath('.') + '/images/'
 MONTAGE_FOLDER = os.path.realpath('.') + '/montages/'
 CURMONTAGE_FOLDER = os.path.realpath('.') + '/curmontage/'
+THUMBNAIL_FOLDER = os.path.realpath('.') + '/thumbnails/'
 MONTAGE_FILE = 'tmpmontage.jpg'
+THUMBNAIL_MANIFEST = 'manifest.json'
+THUMB_SIZE = (133, 150)
 INTENTIONS_DB = 'intentions.db'
+DEFAULT_EVENT = 'default'
 SERVER_LIST = [7000, 7001, 7002]
 my_port = 7001
 master_port = 7000
@@ -39,13 +54,25 @@ app = Flask(__name__)
 # Load default config and override config from an environment variable
 app.config.update(dict(
     DATABASE=os.path.join(app.root_path, 'groupphotosharing.db'),
+    INTENTIONS_SYNCHRONOUS='FULL',
+    PEER_CONNECT_TIMEOUT=2,
+    PEER_TIMEOUT=5,
+    PEER_POOL_SIZE=10,
+    PEER_RETRIES=2,
+    PEER_BACKOFF=0.2,
+    REPLICATION_RETRY_DELAY=1,
+    REPLICATION_MAX_DELAY=60,
+    RECOVERY_INTERVAL=10,
+    VOTE_PERIOD=90,
+    FANOUT_DEADLINE=10,
+    MONTAGE_CACHE_EVENTS=64,
+    EVENTS_PER_PAGE=50,
     DEBUG=True,
     SECRET_KEY='development key'
 ))
 app.config.from_envvar('GROUPPHOTOSHARING_SETTINGS', silent=True)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MONTAGE_FOLDER'] = MONTAGE_FOLDER
-app.config['CURMONTAGE_FOLDER'] = CURMONTAGE_FOLDER
+app.config['EVENTS_FOLDER'] = EVENTS_FOLDER
+app.config['STAGING_FOLDER'] = STAGING_FOLDER
 
 def make_montage(fnames,(ncols,nrows),(photow,photoh),
                        (marl,mart,marr,marb),
@@ -54,7 +81,7 @@ def make_montage(fnames,(ncols,nrows),(photow,photoh),
     Make a contact sheet from a group of filenames:
 
     fnames       A list of names of the image files
-    
+
     ncols        Number of columns in the contact sheet
     nrows        Number of rows in the contact sheet
     photow       The width of the photo thumbs in pixels
@@ -101,34 +128,509 @@ def make_montage(fnames,(ncols,nrows),(photow,photoh),
             count += 1
     return inew
 
+# Montage caches: per event, the resized thumbs and the composed canvas
+# of the last upload set, so that a page view only pastes tiles for new
+# uploads. Only the most recently viewed events are kept.
+montage_caches = OrderedDict()
+montage_caches_lock = threading.Lock()
+
+def get_montage_cache(event_id):
+    with montage_caches_lock:
+        cache = montage_caches.pop(event_id, None)
+        if cache is None:
+            cache = {
+                'key': None,
+                'geometry': None,
+                'canvas': None,
+                'thumbs': {},
+                'lock': threading.Lock()
+            }
+        montage_caches[event_id] = cache
+        while len(montage_caches) > app.config['MONTAGE_CACHE_EVENTS']:
+            montage_caches.popitem(last=False)
+        return cache
+
+def upload_set_key(fnames):
+    """Identifies an upload set by the name, mtime and size of each file
+    """
+    key = []
+    for f in fnames:
+        st = os.stat(f)
+        key.append((os.path.basename(f), st.st_mtime, st.st_size))
+    return tuple(key)
+
+def montage_tile_bbox(index, ncols, (photow,photoh), (marl,mart,marr,marb),
+                      padding):
+    """Returns the bounding box of the thumb at position index"""
+    irow, icol = divmod(index, ncols)
+    left = marl + icol*(photow+padding)
+    upper = mart + irow*(photoh+padding)
+    return (left,upper,left+photow,upper+photoh)
+
+def refresh_montage(cache, fnames, outfile, (ncols,nrows), (photow,photoh),
+                    margins, padding):
+    """\
+    Brings the montage saved at outfile up to date with fnames.
+
+    Takes the same layout arguments as make_montage, and the cache of the
+    event from get_montage_cache. Nothing is read or written if the upload
+    set did not change since the last call; if files were only added,
+    just their tiles are pasted onto the cached canvas. Returns True if
+    outfile was rewritten.
+    """
+    fnames = fnames[:ncols*nrows]
+    geometry = ((ncols,nrows), (photow,photoh), tuple(margins), padding)
+    with cache['lock']:
+        key = upload_set_key(fnames)
+        cached_key = cache['key']
+        canvas = cache['canvas']
+        if canvas is not None and cache['geometry'] == geometry \
+                and key[:len(cached_key)] == cached_key:
+            if key == cached_key and os.path.isfile(outfile):
+                return False
+            start = len(cached_key)
+        else:
+            (marl,mart,marr,marb) = margins
+            isize = (ncols*photow+marl+marr+(ncols-1)*padding,
+                     nrows*photoh+mart+marb+(nrows-1)*padding)
+            canvas = Image.new('RGB',isize,(255,255,255))
+            start = 0
+
+        thumbs = cache['thumbs']
+        count = start
+        while count < len(fnames):
+            if key[count] not in thumbs:
+                try:
+                    img = Image.open(fnames[count])
+                    if img.size != (photow,photoh):
+                        img = img.resize((photow,photoh))
+                    img.load()
+                except:
+                    break
+                thumbs[key[count]] = img
+            bbox = montage_tile_bbox(count, ncols, (photow,photoh),
+                                     margins, padding)
+            canvas.paste(thumbs[key[count]], bbox)
+            count += 1
+
+        # Forget thumbs of files that left the upload set
+        for k in thumbs.keys():
+            if k not in key:
+                del thumbs[k]
+        cache['key'] = key[:count]
+        cache['geometry'] = geometry
+        cache['canvas'] = canvas
+        canvas.save(outfile)
+        return True
+
+def event_folder(event_id, kind):
+    """Returns the directory that holds one kind of files of an event:
+    'images', 'thumbnails', 'curmontage' or 'montages'
+    """
+    return os.path.join(app.config['EVENTS_FOLDER'], event_id, kind) + '/'
+
+def create_event_folders(event_id):
+    for kind in ('images', 'thumbnails', 'curmontage', 'montages'):
+        check_and_createdir(event_folder(event_id, kind))
+
+thumbnail_lock = threading.Lock()
+
+def read_thumbnail_manifest(event_id):
+    """Returns the manifest mapping uploaded file names to their thumbs"""
+    path = os.path.join(event_folder(event_id, 'thumbnails'), THUMBNAIL_MANIFEST)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def write_thumbnail_manifest(event_id, manifest):
+    path = os.path.join(event_folder(event_id, 'thumbnails'), THUMBNAIL_MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.rename(path + '.tmp', path)
+
+def store_thumbnail(event_id, filename):
+    """Makes the montage thumb of an uploaded photo and records it in the
+    manifest. Called once per upload, so the montage never has to decode
+    the full-size original.
+    """
+    src = os.path.join(event_folder(event_id, 'images'), filename)
+    thumbname = filename + '.jpg'
+    try:
+        img = Image.open(src)
+        # JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale
+        img.draft('RGB', THUMB_SIZE)
+        img = img.convert('RGB').resize(THUMB_SIZE, Image.ANTIALIAS)
+        img.save(os.path.join(event_folder(event_id, 'thumbnails'), thumbname))
+    except IOError:
+        print 'cannot make a thumbnail of ' + filename
+        return None
+    with thumbnail_lock:
+        manifest = read_thumbnail_manifest(event_id)
+        manifest[filename] = {'thumb': thumbname, 'added': time.time()}
+        write_thumbnail_manifest(event_id, manifest)
+    return thumbname
+
+def list_thumbnails(event_id):
+    """Returns the paths of all thumbs of an event, in upload order"""
+    manifest = read_thumbnail_manifest(event_id)
+    names = sorted(manifest, key=lambda n: (manifest[n]['added'], n))
+    return [os.path.join(event_folder(event_id, 'thumbnails'),
+                         manifest[n]['thumb'])
+            for n in names]
+
+INTENTIONS_SCHEMA = """
+create table if not exists events (
+    event_id text primary key,
+    name text not null,
+    coordinator integer not null,
+    state text not null,
+    cannot_upload integer not null default 0,
+    vote_txn text,
+    montage_version integer not null default 0,
+    created real not null
+);
+create index if not exists events_by_state on events (state, created);
+create table if not exists participants (
+    event_id text not null,
+    username text not null,
+    primary key (event_id, username)
+);
+create table if not exists votes (
+    event_id text not null,
+    username text not null,
+    vote integer not null,
+    primary key (event_id, username)
+);
+create table if not exists txn_state (
+    key text primary key,
+    value text not null
+);
+create table if not exists montage_versions (
+    event_id text not null,
+    version integer not null,
+    filename text not null,
+    published real not null,
+    primary key (event_id, version)
+);
+create table if not exists txn_log (
+    txn_id text primary key,
+    kind text not null,
+    role text not null,
+    state text not null,
+    coordinator integer,
+    filename text,
+    created real not null,
+    updated real not null,
+    event_id text
+);
+create index if not exists txn_log_open on txn_log (state);
+create index if not exists txn_log_by_event on txn_log (event_id, kind, state);
+create table if not exists site_reports (
+    txn_id text not null,
+    port integer not null,
+    all_yes integer not null,
+    primary key (txn_id, port)
+);
+create table if not exists outbound (
+    id integer primary key autoincrement,
+    port integer not null,
+    path text not null,
+    filename text,
+    params text,
+    attempts integer not null default 0,
+    next_attempt real not null default 0
+);
+"""
+
+# One connection per thread, opened on first use and kept for the
+# lifetime of the thread
+intentions_local = threading.local()
+intentions_init_lock = threading.Lock()
+intentions_initialized = False
+
+def connect_intentions_store():
+    db = sqlite3.connect(app.config['DATABASE'], timeout=30)
+    db.execute('pragma journal_mode=wal')
+    # FULL fsyncs the WAL on every commit, NORMAL only at checkpoints
+    db.execute('pragma synchronous=' + app.config['INTENTIONS_SYNCHRONOUS'])
+    return db
+
 def get_intentions_store():
-    """Opens the intentions list from the server filesystem
+    """Returns this thread's connection to the intentions store. Writes
+    are batched by the callers into a single commit with `with db:`.
+    """
+    global intentions_initialized
+    db = getattr(intentions_local, 'db', None)
+    if db is None:
+        db = connect_intentions_store()
+        with intentions_init_lock:
+            if not intentions_initialized:
+                legacy = prepare_single_event_schema(db)
+                db.executescript(INTENTIONS_SCHEMA)
+                if legacy:
+                    migrate_single_event_store(db)
+                migrate_shelve_store(db)
+                intentions_initialized = True
+        intentions_local.db = db
+    return db
+
+def prepare_single_event_schema(db):
+    """Moves the tables of the single-event schema out of the way.
+    Returns True if there were any.
     """
-    intentions_db = shelve.open(os.path.join(app.root_path, INTENTIONS_DB))
-    return intentions_db
+    columns = [row[1] for row in db.execute('pragma table_info(votes)')]
+    if not columns or 'event_id' in columns:
+        return False
+    with db:
+        db.execute('alter table users rename to legacy_users')
+        db.execute('alter table votes rename to legacy_votes')
+        db.execute('alter table montage_versions '
+                   'rename to legacy_montage_versions')
+        db.execute('alter table txn_log add column event_id text')
+    return True
+
+def migrate_single_event_store(db):
+    """Copies the state of the single-event schema into the default event"""
+    with db:
+        ensure_default_event(db)
+        db.execute('insert or ignore into participants (event_id, username) '
+                   'select ?, username from legacy_users', (DEFAULT_EVENT,))
+        db.execute('insert or ignore into votes (event_id, username, vote) '
+                   'select ?, username, vote from legacy_votes', (DEFAULT_EVENT,))
+        db.execute('insert or ignore into montage_versions '
+                   '(event_id, version, filename, published) '
+                   'select ?, version, filename, published '
+                   'from legacy_montage_versions', (DEFAULT_EVENT,))
+        db.execute('update txn_log set event_id = ? where event_id is null',
+                   (DEFAULT_EVENT,))
+        update_event(db, DEFAULT_EVENT,
+            cannot_upload=get_txn_state(db, 'cannot_upload', False),
+            vote_txn=get_txn_state(db, 'vote_txn'),
+            montage_version=get_txn_state(db, 'montage_version', 0))
+        db.execute('drop table legacy_users')
+        db.execute('drop table legacy_votes')
+        db.execute('drop table legacy_montage_versions')
+
+def migrate_shelve_store(db):
+    """Copies the state of the old shelve based intentions.db, once"""
+    if get_txn_state(db, 'shelve_migrated'):
+        return
+    path = os.path.join(app.root_path, INTENTIONS_DB)
+    with db:
+        if glob.glob(path + '*'):
+            old = shelve.open(path, 'r')
+            ensure_default_event(db)
+            for user in old.get('user_list', []):
+                add_participant(db, DEFAULT_EVENT, user)
+                # A False entry was written both for 'No' and when votes
+                # were reset, so only yes votes can be carried over
+                if old.get(user.encode('ascii', 'ignore')) is True:
+                    set_vote(db, DEFAULT_EVENT, user, True)
+            for key in ('cannot_upload', 'montage_version'):
+                if old.has_key(key):
+                    update_event(db, DEFAULT_EVENT, **{key: old[key]})
+            old.close()
+        set_txn_state(db, 'shelve_migrated', True)
+
+def ensure_default_event(db):
+    """The event that state from before multi-event support belongs to"""
+    db.execute('insert or ignore into events (event_id, name, coordinator, '
+               'state, created) values (?, ?, ?, ?, ?)',
+               (DEFAULT_EVENT, 'Group photo', master_port, 'active', 0))
+
+def get_txn_state(db, key, default=None):
+    row = db.execute('select value from txn_state where key = ?',
+                     (key,)).fetchone()
+    if row is None:
+        return default
+    return json.loads(row[0])
+
+def set_txn_state(db, key, value):
+    db.execute('insert or replace into txn_state (key, value) values (?, ?)',
+               (key, json.dumps(value)))
+
+EVENT_COLUMNS = ('event_id', 'name', 'coordinator', 'state', 'cannot_upload',
+                 'vote_txn', 'montage_version', 'created')
+
+def get_event(db, event_id):
+    row = db.execute('select ' + ', '.join(EVENT_COLUMNS) +
+                     ' from events where event_id = ?', (event_id,)).fetchone()
+    if row is None:
+        return None
+    event = dict(zip(EVENT_COLUMNS, row))
+    event['cannot_upload'] = bool(event['cannot_upload'])
+    return event
+
+def add_event(db, event_id, name, coordinator, state):
+    db.execute('insert or ignore into events (event_id, name, coordinator, '
+               'state, created) values (?, ?, ?, ?, ?)',
+               (event_id, name, coordinator, state, time.time()))
+
+def update_event(db, event_id, **fields):
+    for column in fields:
+        assert column in ('state', 'cannot_upload', 'vote_txn',
+                          'montage_version')
+    db.execute('update events set ' +
+               ', '.join(column + ' = ?' for column in fields) +
+               ' where event_id = ?', fields.values() + [event_id])
+
+def list_events(db, limit):
+    rows = db.execute('select ' + ', '.join(EVENT_COLUMNS) +
+                      ' from events where state = ? '
+                      'order by created desc limit ?',
+                      ('active', limit)).fetchall()
+    return [dict(zip(EVENT_COLUMNS, row)) for row in rows]
+
+def add_participant(db, event_id, username):
+    db.execute('insert or ignore into participants (event_id, username) '
+               'values (?, ?)', (event_id, username))
+
+def get_vote(db, event_id, username):
+    """Returns True or False for a cast vote, None if there is none"""
+    row = db.execute('select vote from votes '
+                     'where event_id = ? and username = ?',
+                     (event_id, username)).fetchone()
+    if row is None:
+        return None
+    return bool(row[0])
+
+def set_vote(db, event_id, username, vote):
+    db.execute('insert or replace into votes (event_id, username, vote) '
+               'values (?, ?, ?)', (event_id, username, int(vote)))
+
+def reset_votes(db, event_id):
+    db.execute('delete from votes where event_id = ?', (event_id,))
+
+def local_vote_status(db, event_id):
+    """False as soon as someone here voted no, True once every participant
+    here voted yes, None while votes are pending
+    """
+    if db.execute('select 1 from votes where event_id = ? and vote = 0 '
+                  'limit 1', (event_id,)).fetchone():
+        return False
+    if all_voted_yes(db, event_id):
+        return True
+    return None
+
+def all_voted_yes(db, event_id):
+    """True if every participant of the event here has voted yes"""
+    row = db.execute('select count(*) from participants left join votes '
+                     'on votes.event_id = participants.event_id '
+                     'and votes.username = participants.username '
+                     'where participants.event_id = ? '
+                     'and (votes.vote is null or votes.vote = 0)',
+                     (event_id,)).fetchone()
+    return row[0] == 0
+
+def record_montage_version(db, event_id, version, filename):
+    db.execute('insert or replace into montage_versions '
+               '(event_id, version, filename, published) values (?, ?, ?, ?)',
+               (event_id, version, filename, time.time()))
+
+def list_montage_versions(db, event_id):
+    return [row[0] for row in db.execute(
+        'select filename from montage_versions where event_id = ? '
+        'order by version', (event_id,))]
+
+# Transaction log. Coordinators go through 'preparing' (photos, events)
+# or 'collecting' (votes), then 'commit' or 'abort' once the decision is
+# taken; every site ends in 'committed' or 'aborted' once the decision
+# has been applied locally. Participants hold prepared work as 'prepared'.
+TXN_DONE = ('committed', 'aborted')
+TXN_COLUMNS = ('txn_id', 'kind', 'role', 'state', 'coordinator', 'filename',
+               'created', 'event_id')
+
+def log_txn(db, txn_id, kind, role, state, coordinator=None, filename=None,
+            event_id=None):
+    now = time.time()
+    db.execute('insert or ignore into txn_log (txn_id, kind, role, state, '
+               'coordinator, filename, created, updated, event_id) '
+               'values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+               (txn_id, kind, role, state, coordinator, filename, now, now,
+                event_id))
+    db.execute('update txn_log set state = ?, updated = ? where txn_id = ?',
+               (state, now, txn_id))
+
+def get_txn(db, txn_id):
+    row = db.execute('select ' + ', '.join(TXN_COLUMNS) +
+                     ' from txn_log where txn_id = ?', (txn_id,)).fetchone()
+    return dict(zip(TXN_COLUMNS, row)) if row is not None else None
+
+def list_open_txns(db, kind=None, role=None):
+    rows = db.execute('select ' + ', '.join(TXN_COLUMNS) +
+                      ' from txn_log where state not in (?, ?) '
+                      'order by created', TXN_DONE).fetchall()
+    return [dict(zip(TXN_COLUMNS, row)) for row in rows
+            if kind in (None, row[1]) and role in (None, row[2])]
+
+def open_vote_txn(db, event_id):
+    """Returns the id of the vote round the master is collecting, if any"""
+    row = db.execute('select txn_id from txn_log where event_id = ? '
+                     'and kind = ? and state = ?',
+                     (event_id, 'vote', 'collecting')).fetchone()
+    return row[0] if row is not None else None
 
 @app.teardown_appcontext
 def close_db(error):
-    """Closes the database again at the end of the request."""
-    if hasattr(g, 'intentions_db'):
-        g.intentions_db.close()
+    """Rolls back whatever a failed request left uncommitted. The
+    connection itself stays open for the next request on this thread.
+    """
+    db = getattr(intentions_local, 'db', None)
+    if db is not None and error is not None:
+        db.rollback()
+
+def get_event_or_404(db, event_id):
+    event = get_event(db, event_id)
+    if event is None or not event['state'] == 'active':
+        abort(404)
+    return event
 
-@app.route('/uploads/<filename>')
-def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+@app.route('/events/<event_id>/uploads/<filename>')
+def uploaded_file(event_id, filename):
+    return send_from_directory(event_folder(event_id, 'images'), filename)
 
-@app.route('/montages/<filename>')
-def montage_file(filename):
-    return send_from_directory(app.config['MONTAGE_FOLDER'], filename)
+@app.route('/events/<event_id>/montages/<filename>')
+def montage_file(event_id, filename):
+    return send_from_directory(event_folder(event_id, 'montages'), filename)
 
-@app.route('/curmontage/<filename>')
-def curmontage_file(filename):
-    return send_from_directory(app.config['CURMONTAGE_FOLDER'], filename)
+@app.route('/events/<event_id>/curmontage/<filename>')
+def curmontage_file(event_id, filename):
+    return send_from_directory(event_folder(event_id, 'curmontage'), filename)
 
 @app.route('/')
-def show_entries():
+def show_events():
+    if 'username' in request.cookies:
+        session['logged_in'] = True
+        session['username'] = request.cookies.get('username')
+    else:
+        return redirect(url_for('login'))
+
+    db = get_intentions_store()
+    events = list_events(db, app.config['EVENTS_PER_PAGE'])
+    return render_template('events.html', events=events)
+
+@app.route('/events', methods=['POST'])
+def create_event():
+    db = get_intentions_store()
+    if not session.get('logged_in'):
+        abort(401)
+    name = request.form.get('name', '').strip()
+    if not name:
+        flash('Your event needs a name')
+        return redirect(url_for('show_events'))
+
+    event_id = uuid.uuid4().hex
+    if distribute_event(db, uuid.uuid4().hex, event_id, name):
+        flash('Event created')
+        return redirect(url_for('show_entries', event_id=event_id))
+    flash('A site is down. The event was not created')
+    return redirect(url_for('show_events'))
+
+@app.route('/events/<event_id>/')
+def show_entries(event_id):
     global my_port
-    global master_port
 
     if 'username' in request.cookies:
         session['logged_in'] = True
@@ -136,20 +638,16 @@ def show_entries():
     else:
         return redirect(url_for('login'))
 
-    intentions = get_intentions_store()
+    db = get_intentions_store()
+    event = get_event_or_404(db, event_id)
     if session.get('logged_in'):
-        if intentions.has_key('cannot_upload'.encode('ascii','ignore')):
-            session['cannot_upload'] = intentions['cannot_upload']
-        else:
-            intentions['cannot_upload'] = False
-        if intentions.has_key(session.get('username').encode('ascii','ignore')):
-            session['cannot_vote'] = intentions[session.get('username').encode('ascii','ignore')]
-        else:
-            session['cannot_vote'] = False
+        with db:
+            add_participant(db, event_id, session.get('username'))
+        session['cannot_upload'] = event['cannot_upload']
+        session['cannot_vote'] = get_vote(db, event_id, session.get('username')) is not None
     else:
             session['cannot_upload'] = False
             session['cannot_vote'] = False
-            intentions['cannot_upload'] = False
 
     """
     if not hasattr(g, 'up_to_date'):
@@ -180,261 +678,287 @@ def show_entries():
         except requests.exceptions.RequestException:
             print 'request exception at get_montage_version'
         """
-    if not my_port == master_port:
-        my_file_list = os.listdir('./images')
-        url_get_image = 'http://localhost:'+str(master_port)+'/get_image'
-        url_list_image = 'http://localhost:'+str(master_port)+'/list_image'
-        try:
-            r = requests.get(url_list_image)
-        except requests.exceptions.RequestException:
-            flash('OMG, Master server is down')
-        resp_json = r.json()
-        for filename in resp_json['file_list']:
-            if filename in my_file_list:
-                continue
-            payload = { 'filename': filename }
-            try:
-                r = requests.get(url_get_image, params=payload)
-                img = Image.open(StringIO(r.content))
-                img.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            except requests.exceptions.RequestException:
-                flash('OMG, Master server is down')
 
-    current_montage_available=False
+    current_montage_available = render_current_montage(event_id)
+    publishedfiles = list_montage_versions(db, event_id)
+    return render_template('show_entries.html', event=event,
+        publishedmontages=publishedfiles,
+        montage_state=current_montage_available)
+
+def render_current_montage(event_id):
+    """Brings the current montage of an event up to date with its
+    uploads. Returns False if there is nothing to show.
+    """
     ncols,nrows = 3,4
-    files = glob.glob(os.path.realpath('.')+'\images\*.*')
+    # Oldest first, so that a new upload only appends a tile
+    files = list_thumbnails(event_id)
     # Don't bother reading in files we aren't going to use
-    if len(files) > ncols*nrows: 
+    if len(files) > ncols*nrows:
         files = files[:ncols*nrows]
     # These are all in terms of pixels:
-    photow,photoh = 133,150
+    photow,photoh = THUMB_SIZE
     photo = (photow,photoh)
     margins = [5,5,5,5]
     padding = 1
-    if files:
-        inew = make_montage(files,(ncols,nrows),photo,margins,padding)
-        inew.save(os.path.join(app.config['CURMONTAGE_FOLDER'], MONTAGE_FILE))
-        current_montage_available=True
-    publishedfiles = os.listdir('./montages')
-    return render_template('show_entries.html', publishedmontages=publishedfiles, 
-        montage_state=current_montage_available)
-
-@app.route('/add', methods=['POST'])
-def add_entry():
+    if not files:
+        return False
+    refresh_montage(get_montage_cache(event_id), files,
+        os.path.join(event_folder(event_id, 'curmontage'), MONTAGE_FILE),
+        (ncols,nrows),photo,margins,padding)
+    return True
+
+@app.route('/events/<event_id>/add', methods=['POST'])
+def add_entry(event_id):
     global my_port
-    global master_port
-    intentions = get_intentions_store()
+    db = get_intentions_store()
     if not session.get('logged_in'):
         abort(401)
+    event = get_event_or_404(db, event_id)
+    coordinator = event['coordinator']
+
 
-    
-    if not my_port == master_port:
-        url = 'http://localhost:'+str(master_port)+'/get_cannot_upload'
+    if not my_port == coordinator:
         try:
-            resp = requests.post(url)
+            resp = peer_request(coordinator, 'post',
+                                '/events/'+event_id+'/get_cannot_upload')
             resp_json = resp.json()
-            intentions['cannot_upload'] = resp_json['cannot_upload']
+            with db:
+                update_event(db, event_id,
+                             cannot_upload=resp_json['cannot_upload'])
+            event['cannot_upload'] = resp_json['cannot_upload']
         except requests.exceptions.RequestException:
             flash('OMG, master server is down!')
-    
 
-    can_add = True
-    if intentions.has_key('cannot_upload'.encode('ascii','ignore')):
-        can_add = not intentions['cannot_upload']
+
+    can_add = not event['cannot_upload']
 
     if request.method == 'POST' and 'photo' in request.files and can_add:
         file = request.files['photo']
         filename = secure_filename(file.filename)
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        if not my_port == master_port:
-            """send_image(os.path.join(app.config['UPLOAD_FOLDER'], filename), master_port)"""
-            url = 'http://localhost:'+str(master_port)+'/post_image'
-            files = {'file': open(os.path.join(app.config['UPLOAD_FOLDER'], filename), 'rb')}
-            try:
-                r = requests.post(url, files=files)
-            except requests.exceptions.RequestException:
-                flash('Server at port' +str(port)+' is down. Cannot send the image')
-        """
+        txn_id = uuid.uuid4().hex
+        file.save(staged_path(txn_id))
+        if distribute_photo(db, txn_id, event_id, filename):
+            flash('Photo Saved')
         else:
-            for port in SERVER_LIST:
-                if not port == my_port and not port == master_port:
-                    url = 'http://localhost:'+str(port)+'/set_dirty'
-                    try:
-                        requests.post(url)
-                    except requests.exceptions.RequestException:
-                        flash('Server at port' +str(port)+' is down. Cannot update dirty flag')
-        """
-        flash('Photo Saved')
+            flash('Voting has begun or a site is down. Your photo was not saved')
     else:
         if not can_add:
             flash('Voting has begun. You cannot upload till voting is done')
         else:
             flash('No photo found in request')
 
-    return redirect(url_for('show_entries'))
+    return redirect(url_for('show_entries', event_id=event_id))
 
-@app.route('/vote', methods=['POST'])
-def vote():
+@app.route('/events/<event_id>/vote', methods=['POST'])
+def vote(event_id):
     global my_port
-    global master_port
 
-    intentions = get_intentions_store()
+    db = get_intentions_store()
     if not session.get('logged_in'):
         abort(401)
-    if session.get('cannot_vote'):
+    event = get_event_or_404(db, event_id)
+    coordinator = event['coordinator']
+    if get_vote(db, event_id, session.get('username')) is not None:
         flash('You have already voted. You cannot change your vote')
-        return redirect(url_for('show_entries'))
+        return redirect(url_for('show_entries', event_id=event_id))
     if request.method == 'POST':
-        if intentions.has_key('cannot_upload'.encode('ascii','ignore')):
-            if not intentions['cannot_upload'.encode('ascii','ignore')]:
-                intentions['cannot_upload'.encode('ascii','ignore')] = True
-                intentions.sync()
-                if my_port == master_port:
-                    threading.Thread(target=collect_votes).start()
-                else:
-                    url = 'http://localhost:'+str(master_port)+'/start_vote'
-                    try:
-                        resp = requests.post(url)
-                    except requests.exceptions.RequestException:
-                        flash('OMG, Master server is down')
-            else:
-                intentions['cannot_upload'.encode('ascii','ignore')] = True
-                intentions.sync()
-        else:
-            intentions['cannot_upload'.encode('ascii','ignore')] = True
-            intentions.sync()
-            if my_port == master_port:
-                threading.Thread(target=collect_votes).start()
+        vote_val = request.form['vote_val']
+        # The upload lock and the vote go to disk in a single commit
+        with db:
+            update_event(db, event_id, cannot_upload=True)
+            if vote_val in ('Yes', 'No'):
+                add_participant(db, event_id, session.get('username'))
+                set_vote(db, event_id, session.get('username'), vote_val == 'Yes')
+
+        if not event['cannot_upload']:
+            if my_port == coordinator:
+                start_vote_round(db, event_id)
             else:
-                for port in SERVER_LIST:
-                    if not port == my_port:
-                        url = 'http://localhost:'+str(port)+'/start_vote'
-                        try:
-                            resp = requests.post(url)
-                        except requests.exceptions.RequestException:
-                            continue
+                resp = fan_out('/events/'+event_id+'/start_vote',
+                               ports=[coordinator])[coordinator]
+                if resp is None:
+                    flash('OMG, Master server is down')
+                else:
+                    with db:
+                        update_event(db, event_id,
+                                     vote_txn=resp.json()['txn_id'])
+        report_site_votes(db, event_id)
 
-        vote_val = request.form['vote_val']
         if vote_val == 'Yes':
             flash('You voted yes')
-            intentions[session.get('username').encode('ascii','ignore')] = True
-            intentions.sync()
             session['cannot_upload'] = True
             session['cannot_vote'] = True
         elif vote_val == 'No':
             flash('You voted no')
-            intentions[session.get('username').encode('ascii','ignore')] = False
-            intentions.sync()
             session['cannot_upload'] = True
             session['cannot_vote'] = True
-    redirect_to_index = redirect(url_for('show_entries'))
+    redirect_to_index = redirect(url_for('show_entries', event_id=event_id))
     response = app.make_response(redirect_to_index)
     return response
 
-"""@copy_current_request_context"""
-def collect_votes():
+# Vote rounds are decided as soon as every site has reported or one
+# site reports a no; the vote period only bounds how long that may take
+vote_round_lock = threading.Lock()
+vote_timers = {}
+
+def start_vote_round(db, event_id):
+    """Opens a vote round as the master of the event. Returns its txn id."""
     global my_port
-    print 'collect_votes before sleep'
-    time.sleep(90)
-    print 'collect_votes after sleep'
-    can_commit = True
-    intentions = get_intentions_store()
-
-    for port in SERVER_LIST:
-        if not port == my_port:
-            url = 'http://localhost:'+str(port)+'/get_can_commit'
-            try:
-                resp = requests.post(url)
-            except requests.exceptions.RequestException:
-                continue
-            resp_json = resp.json()
-            if not resp_json['can_commit']:
-                can_commit = False
-        else:
-            continue
+    with vote_round_lock:
+        txn_id = open_vote_txn(db, event_id)
+        if txn_id is not None:
+            return txn_id
+        txn_id = uuid.uuid4().hex
+        with db:
+            log_txn(db, txn_id, 'vote', 'coordinator', 'collecting', my_port,
+                    event_id=event_id)
+            update_event(db, event_id, cannot_upload=True, vote_txn=txn_id)
+    vote_timers[txn_id] = schedule(time.time() + app.config['VOTE_PERIOD'],
+                                   collect_votes, txn_id)
+    # The other sites lock uploads and report once their voters are done
+    fan_out('/events/'+event_id+'/start_vote', data={'txn_id': txn_id})
+    report_site_votes(db, event_id)
+    return txn_id
+
+def report_site_votes(db, event_id):
+    """Tells the master once every participant here has voted, or as soon
+    as one of them voted no
+    """
+    all_yes = local_vote_status(db, event_id)
+    if all_yes is None:
+        return
+    event = get_event(db, event_id)
+    if my_port == event['coordinator']:
+        record_site_report(db, event_id, event['vote_txn'], my_port, all_yes)
+        return
+    try:
+        peer_request(event['coordinator'], 'post',
+                     '/events/'+event_id+'/site_voted',
+                     data={'txn_id': event['vote_txn'], 'port': my_port,
+                           'all_yes': all_yes})
+    except requests.exceptions.RequestException:
+        # The master asks us itself when the vote period ends
+        print 'could not report votes to the master'
+
+def record_site_report(db, event_id, txn_id, port, all_yes):
+    if txn_id is None:
+        txn_id = open_vote_txn(db, event_id)
+        if txn_id is None:
+            return
+    with db:
+        db.execute('insert or replace into site_reports (txn_id, port, all_yes) '
+                   'values (?, ?, ?)', (txn_id, port, int(all_yes)))
+    check_vote_round(db, txn_id)
+
+def get_site_reports(db, txn_id):
+    return dict((port, bool(all_yes)) for port, all_yes in db.execute(
+        'select port, all_yes from site_reports where txn_id = ?', (txn_id,)))
+
+def check_vote_round(db, txn_id):
+    """Decides the round right away if the reports allow it"""
+    reports = get_site_reports(db, txn_id)
+    if not all(reports.values()):
+        decide_vote(db, txn_id, False)
+    elif all(port in reports for port in SERVER_LIST):
+        decide_vote(db, txn_id, True)
 
-    if intentions.has_key('user_list'):
-        users = intentions['user_list']
-    else:
-        users = []
-        users.append(session['username'])
-        intentions['user_list'] = users
-
-    for user in users:
-        if intentions.has_key(user.encode('ascii', 'ignore')):
-            if not intentions[user.encode('ascii', 'ignore')]:
-                can_commit = False
-        else:
+"""@copy_current_request_context"""
+def collect_votes(txn_id):
+    """Decides a round whose vote period ran out, asking the sites that
+    have not reported
+    """
+    global my_port
+    db = get_intentions_store()
+    txn = get_txn(db, txn_id)
+    if txn is None or not txn['state'] == 'collecting':
+        return
+    event_id = txn['event_id']
+    reports = get_site_reports(db, txn_id)
+    can_commit = all(reports.values())
+
+    # A site that does not answer in time cannot have voted yes
+    missing = [port for port in SERVER_LIST
+               if port not in reports and not port == my_port]
+    for port, resp_json in fan_out_json('/events/'+event_id+'/get_can_commit',
+                                        ports=missing).items():
+        if resp_json is None or not resp_json['can_commit']:
             can_commit = False
-    
-    check_and_commit(can_commit)
-    for port in SERVER_LIST:
-        if not port == my_port:
-            url = 'http://localhost:'+str(port)+'/commit'
-            payload = {'can_commit':can_commit}
-            try:
-                requests.get(url, params=payload)
-            except requests.exceptions.RequestException:
-                continue
 
-
-@app.route('/check_and_commit', methods=['GET', 'POST'])
-def check_and_commit(can_commit):
-    intentions = get_intentions_store()
-    can_commit = True
-    users = []
+    if my_port not in reports and not all_voted_yes(db, event_id):
+        can_commit = False
+
+    decide_vote(db, txn_id, can_commit)
+
+def decide_vote(db, txn_id, can_commit):
+    """Logs the master's decision once and follows through with it"""
+    with vote_round_lock:
+        txn = get_txn(db, txn_id)
+        if txn is None or not txn['state'] == 'collecting':
+            return
+        event_id = txn['event_id']
+        # Once logged, the decision is delivered until every site has it
+        with db:
+            log_txn(db, txn_id, 'vote', 'coordinator',
+                    'commit' if can_commit else 'abort')
+            enqueue_peer_message(db, '/events/'+event_id+'/commit',
+                                 params={'txn_id': txn_id, 'can_commit': can_commit})
+    if txn_id in vote_timers:
+        cancel_timer(vote_timers.pop(txn_id))
+    wake_replicator()
+    check_and_commit(event_id, can_commit, txn_id)
+
+
+def check_and_commit(event_id, can_commit, txn_id=None):
+    db = get_intentions_store()
     print 'check_and_commit 1'
 
-    if not os.path.isfile(os.path.join(app.config['CURMONTAGE_FOLDER'], MONTAGE_FILE)):
-        return
+    # Sites that nobody looked at have not rendered the montage yet
+    if can_commit and not render_current_montage(event_id):
+        can_commit = False
     if can_commit:
-        print 'check_and_commit 2'  
-        if intentions.has_key('montage_version'.encode('ascii','ignore')):
-            montage_version = intentions['montage_version']+1
-        else:
-            montage_version = 1
-
-        intentions['montage_version'] = montage_version
+        print 'check_and_commit 2'
+        montage_version = get_event(db, event_id)['montage_version']+1
+        montage_file = str(montage_version)+'.jpg'
 
-        shutil.copy2(os.path.join(app.config['CURMONTAGE_FOLDER'], MONTAGE_FILE), 
-            os.path.join('./montages/', str(montage_version)+'.jpg') )
+        shutil.copy2(os.path.join(event_folder(event_id, 'curmontage'), MONTAGE_FILE),
+            os.path.join(event_folder(event_id, 'montages'), montage_file) )
 
-        files1 = glob.glob(os.path.realpath('.')+'\images\*.*')
+        files1 = glob.glob(os.path.join(event_folder(event_id, 'images'), '*.*'))
         for f in files1:
             os.remove(f)
 
-        files2 = glob.glob(os.path.realpath('.')+'\curmontage\*.*')
+        files2 = glob.glob(os.path.join(event_folder(event_id, 'curmontage'), '*.*'))
         for f in files2:
             os.remove(f)
 
-    users = intentions['user_list'.encode('ascii','ignore')]
-    for user in users:
-        intentions[user.encode('ascii', 'ignore')] = False
+        with thumbnail_lock:
+            files3 = glob.glob(os.path.join(event_folder(event_id, 'thumbnails'), '*.*'))
+            for f in files3:
+                os.remove(f)
 
-    intentions['cannot_upload'] = False
-    intentions.sync()
+    with db:
+        if can_commit:
+            update_event(db, event_id, montage_version=montage_version)
+            record_montage_version(db, event_id, montage_version, montage_file)
+        reset_votes(db, event_id)
+        update_event(db, event_id, cannot_upload=False)
+        if txn_id is not None:
+            log_txn(db, txn_id, 'vote', 'participant',
+                    'committed' if can_commit else 'aborted',
+                    event_id=event_id)
 
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     error = None
 
-    intentions = get_intentions_store()
     if request.method == 'POST':
-        username = request.form['username'] 
-        if intentions.has_key('user_list'):
-            users = intentions['user_list']
-            users.append(username)
-            intentions['user_list'] = users
-        else:
-            users = []
-            users.append(username)
-            intentions['user_list'] = users
-            
+        username = request.form['username']
+
         flash('You were logged in')
         session['logged_in'] = True
         session['username'] = username
-        redirect_to_index = redirect(url_for('show_entries'))
+        redirect_to_index = redirect(url_for('show_events'))
         response = app.make_response(redirect_to_index)
         response.set_cookie('username', username)
         return response
@@ -448,16 +972,24 @@ def logout():
     session.pop('cannot_upload', None)
     session.pop('cannot_vote', None)
     flash('You were logged out')
-    redirect_to_index = redirect(url_for('show_entries'))
+    redirect_to_index = redirect(url_for('show_events'))
     response = app.make_response(redirect_to_index)
     response.set_cookie('username', expires=0)
     return response
 
-@app.route('/post_image', methods=['POST'])
-def post_image():
+@app.route('/events/<event_id>/post_image', methods=['POST'])
+def post_image(event_id):
     file = request.files['file']
     filename = secure_filename(file.filename)
-    file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    path = os.path.join(event_folder(event_id, 'images'), filename)
+    file.save(path + '.part')
+    # Pushes are retried until acknowledged, so the same photo may
+    # arrive more than once
+    if os.path.isfile(path) and filecmp.cmp(path + '.part', path, shallow=False):
+        os.remove(path + '.part')
+    else:
+        os.rename(path + '.part', path)
+        store_thumbnail(event_id, filename)
     response = app.make_response('')
     response.status_code = 200
     return response
@@ -469,107 +1001,555 @@ def set_dirty():
     response.status_code = 200
     return response
 
-@app.route('/start_vote', methods=['POST'])
-def start_vote():
+@app.route('/events/<event_id>/start_vote', methods=['POST'])
+def start_vote(event_id):
     global my_port
-    global master_port
-    intentions = get_intentions_store()
-    if not intentions['cannot_upload'] and my_port == master_port:
-        intentions['cannot_upload'.encode('ascii','ignore')] = True
-        intentions.sync()
-        threading.Thread(target=collect_votes).start()
+    db = get_intentions_store()
+    event = get_event_or_404(db, event_id)
+    if my_port == event['coordinator']:
+        txn_id = start_vote_round(db, event_id)
     else:
-        intentions['cannot_upload'.encode('ascii','ignore')] = True
-        intentions.sync()
+        txn_id = request.values.get('txn_id')
+        with db:
+            update_event(db, event_id, cannot_upload=True, vote_txn=txn_id)
+        report_site_votes(db, event_id)
+    return jsonify(txn_id=txn_id)
+
+@app.route('/events/<event_id>/site_voted', methods=['POST'])
+def site_voted(event_id):
+    db = get_intentions_store()
+    record_site_report(db, event_id, request.form.get('txn_id') or None,
+                       int(request.form['port']),
+                       request.form['all_yes'] in ('True', 'true', '1'))
     response = app.make_response('')
     response.status_code = 200
     return response
 
-@app.route('/commit', methods=['POST', 'GET'])
-def commit():
-    can_commit = request.args.get('can_commit')
-    check_and_commit(can_commit)
+@app.route('/events/<event_id>/commit', methods=['POST', 'GET'])
+def commit(event_id):
+    db = get_intentions_store()
+    get_event_or_404(db, event_id)
+    txn_id = request.values.get('txn_id')
+    can_commit = request.values.get('can_commit') in ('True', 'true', '1')
+    # The decision is resent until acknowledged, so apply it only once
+    txn = get_txn(db, txn_id) if txn_id else None
+    if txn is None or txn['state'] not in TXN_DONE:
+        check_and_commit(event_id, can_commit, txn_id)
     response = app.make_response('')
     response.status_code = 200
     return response
 
-@app.route('/list_image', methods=['GET'])
-def list_image():
-    file_list = os.listdir(os.path.realpath('.')+'\images')
+@app.route('/events/<event_id>/list_image', methods=['GET'])
+def list_image(event_id):
+    file_list = os.listdir(event_folder(event_id, 'images'))
     return jsonify(file_list=file_list)
 
-@app.route('/list_montages', methods=['GET', 'POST'])
-def list_montages():
-    file_list = os.listdir(os.path.realpath('.')+'\montages')
+@app.route('/events/<event_id>/list_montages', methods=['GET', 'POST'])
+def list_montages(event_id):
+    file_list = os.listdir(event_folder(event_id, 'montages'))
     return jsonify(file_list=file_list)
 
-@app.route('/get_montage_version', methods=['GET', 'POST'])
-def get_montage_version():
-    intentions = get_intentions_store()
-    if intentions.has_key('montage_version'):
-        montage_version = intentions['montage_version']
-    else:
-        montage_version = 1
+@app.route('/events/<event_id>/get_montage_version', methods=['GET', 'POST'])
+def get_montage_version(event_id):
+    db = get_intentions_store()
+    montage_version = get_event_or_404(db, event_id)['montage_version']
     return jsonify(montage_version=montage_version)
 
-@app.route('/get_montage_image', methods=['GET'])
-def get_montage_image():
+@app.route('/events/<event_id>/get_montage_image', methods=['GET'])
+def get_montage_image(event_id):
     filename = request.args.get('filename')
-    return send_from_directory(app.config['MONTAGE_FOLDER'], filename)
+    return send_from_directory(event_folder(event_id, 'montages'), filename)
 
-@app.route('/get_image', methods=['GET'])
-def get_image():
+@app.route('/events/<event_id>/get_image', methods=['GET'])
+def get_image(event_id):
     filename = request.args.get('filename')
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_from_directory(event_folder(event_id, 'images'), filename)
 
-@app.route('/get_cannot_upload', methods=['POST'])
-def get_cannot_upload():
-    intentions = get_intentions_store()
-    cannot_upload = intentions['cannot_upload']
+@app.route('/events/<event_id>/get_cannot_upload', methods=['POST'])
+def get_cannot_upload(event_id):
+    db = get_intentions_store()
+    cannot_upload = get_event_or_404(db, event_id)['cannot_upload']
     return jsonify(cannot_upload=cannot_upload)
 
-@app.route('/get_can_commit', methods=['POST'])
-def get_can_commit():
+@app.route('/peer_stats', methods=['GET'])
+def peer_stats():
+    stats = peer_connection_stats()
+    return jsonify(peers=dict((str(port), s) for port, s in stats.items()))
 
-    intentions = get_intentions_store()
-    can_commit = True
+@app.route('/events/<event_id>/get_can_commit', methods=['POST'])
+def get_can_commit(event_id):
+    db = get_intentions_store()
+    can_commit = all_voted_yes(db, event_id)
+    return jsonify(can_commit=can_commit)
 
-    if intentions.has_key('user_list'):
-        users = intentions['user_list']
 
-    for user in users:
-        if intentions.has_key(user.encode('ascii', 'ignore')):
-            if not intentions[user.encode('ascii', 'ignore')]:
-                can_commit = False
-        else:
-            can_commit = False
+@app.route('/prepare_event', methods=['POST'])
+def prepare_event():
+    """Phase one of creating an event: records it as a shadow event"""
+    db = get_intentions_store()
+    txn_id = request.form['txn_id']
+    txn = get_txn(db, txn_id)
+    if txn is None:
+        event_id = request.form['event_id']
+        create_event_folders(event_id)
+        with db:
+            add_event(db, event_id, request.form['name'],
+                      int(request.form['coordinator']), 'preparing')
+            log_txn(db, txn_id, 'event', 'participant', 'prepared',
+                    int(request.form['coordinator']), event_id=event_id)
+        return jsonify(vote=True)
+    return jsonify(vote=txn['state'] in ('prepared', 'committed'))
+
+@app.route('/events/<event_id>/prepare_photo', methods=['POST'])
+def prepare_photo(event_id):
+    """Phase one of a photo transaction: stages the photo and votes"""
+    db = get_intentions_store()
+    txn_id = request.form['txn_id']
+    txn = get_txn(db, txn_id)
+    if txn is None:
+        event = get_event(db, event_id)
+        if event is None or not event['state'] == 'active' \
+                or event['cannot_upload']:
+            with db:
+                log_txn(db, txn_id, 'photo', 'participant', 'aborted',
+                        event_id=event_id)
+            return jsonify(vote=False)
+        request.files['file'].save(staged_path(txn_id))
+        fsync_file(staged_path(txn_id))
+        with db:
+            log_txn(db, txn_id, 'photo', 'participant', 'prepared',
+                    int(request.form['coordinator']),
+                    secure_filename(request.form['filename']), event_id)
+        return jsonify(vote=True)
+    return jsonify(vote=txn['state'] in ('prepared', 'committed'))
+
+@app.route('/commit_<kind>', methods=['POST'])
+def commit_txn(kind):
+    if kind not in TXN_KINDS:
+        abort(404)
+    db = get_intentions_store()
+    apply_txn_decision(db, request.form['txn_id'], kind, True)
+    return jsonify(ok=True)
+
+@app.route('/abort_<kind>', methods=['POST'])
+def abort_txn(kind):
+    if kind not in TXN_KINDS:
+        abort(404)
+    db = get_intentions_store()
+    apply_txn_decision(db, request.form['txn_id'], kind, False)
+    return jsonify(ok=True)
+
+@app.route('/txn_status', methods=['GET'])
+def txn_status():
+    db = get_intentions_store()
+    txn = get_txn(db, request.args.get('txn_id'))
+    return jsonify(state=txn['state'] if txn is not None else 'unknown')
+
+# One pooled keep-alive session per peer
+peer_sessions = {}
+peer_sessions_lock = threading.Lock()
+
+def peer_url(port, path=''):
+    return 'http://localhost:'+str(port)+path
+
+def get_peer_session(port):
+    """Returns the pooled session used for all calls to a peer"""
+    with peer_sessions_lock:
+        sess = peer_sessions.get(port)
+        if sess is None:
+            # Every internal call may be repeated safely, since the sites
+            # have to cope with duplicated operations anyway
+            retry_kwargs = dict(total=app.config['PEER_RETRIES'],
+                                backoff_factor=app.config['PEER_BACKOFF'],
+                                status_forcelist=(502, 503, 504),
+                                raise_on_status=False)
+            if hasattr(Retry, 'DEFAULT_ALLOWED_METHODS'):
+                retry_kwargs['allowed_methods'] = None
+            else:
+                retry_kwargs['method_whitelist'] = None
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=app.config['PEER_POOL_SIZE'],
+                                  max_retries=Retry(**retry_kwargs))
+            sess = requests.Session()
+            sess.mount(peer_url(port), adapter)
+            peer_sessions[port] = sess
+        return sess
+
+def peer_request(port, method, path, **kwargs):
+    """Makes a call to a peer over its pooled session"""
+    kwargs.setdefault('timeout', (app.config['PEER_CONNECT_TIMEOUT'],
+                                  app.config['PEER_TIMEOUT']))
+    return get_peer_session(port).request(method, peer_url(port, path),
+                                          **kwargs)
+
+def peer_connection_stats():
+    """Returns, per peer, how many connections were opened and how many
+    requests went over an already open one
+    """
+    stats = {}
+    for port, sess in peer_sessions.items():
+        pool = sess.get_adapter(peer_url(port)).poolmanager \
+            .connection_from_url(peer_url(port))
+        stats[port] = {'requests': pool.num_requests,
+                       'opened': pool.num_connections,
+                       'reused': pool.num_requests - pool.num_connections}
+    return stats
+
+def fan_out(path, method='post', params=None, ports=None, timeout=None,
+            deadline=None, data=None, upload=None):
+    """\
+    Sends the same call to several peers at once:
 
-    return jsonify(can_commit=can_commit)
+    path         The path of the call, e.g. '/get_can_commit'
+    method       The HTTP method of the call
+    params       The query parameters of the call
+    data         The form fields of the call
+    upload       The path of a file to send along as the 'file' field
 
+    ports        The peers to call, every other site by default
+    timeout      The connect and read timeout of each call in seconds
+    deadline     The time in seconds after which the round stops waiting
+                 for peers that have not answered
 
-def send_image(image, port):
-    global my_port
-    if port == my_port:
-        return
+    returns a dict mapping each port to its response, or to None if the
+    call failed or missed the deadline.
+    """
+    if ports is None:
+        ports = [port for port in SERVER_LIST if not port == my_port]
+    if timeout is None:
+        timeout = (app.config['PEER_CONNECT_TIMEOUT'],
+                   app.config['PEER_TIMEOUT'])
+    if deadline is None:
+        deadline = app.config['FANOUT_DEADLINE']
+
+    results = dict((port, None) for port in ports)
+    def call(port):
+        files = None
+        if upload is not None:
+            files = {'file': open(upload, 'rb')}
+        try:
+            resp = peer_request(port, method, path, params=params, data=data,
+                                files=files, timeout=timeout)
+        except requests.exceptions.RequestException:
+            print 'Server at port '+str(port)+' is down. '+path+' failed'
+            return
+        finally:
+            if files:
+                files['file'].close()
+        if resp.ok:
+            results[port] = resp
+
+    threads = []
+    for port in ports:
+        t = threading.Thread(target=call, args=(port,))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    end = time.time() + deadline
+    for t in threads:
+        t.join(max(0, end - time.time()))
+    # Stragglers may still write into results once we are gone
+    return dict(results)
+
+def fan_out_json(path, **kwargs):
+    """Like fan_out, but returns the decoded JSON bodies"""
+    results = {}
+    for port, resp in fan_out(path, **kwargs).items():
+        try:
+            results[port] = resp.json() if resp is not None else None
+        except ValueError:
+            results[port] = None
+    return results
+
+# Outbound queue: messages to peers that are retried from a background
+# thread until the peer acknowledges them
+replicator_wakeup = threading.Event()
+replicator_thread = None
+replicator_lock = threading.Lock()
+
+def enqueue_peer_message(db, path, filename=None, params=None, ports=None):
+    """\
+    Queues a POST to path for each peer. The caller commits the queue
+    entries together with the state change they announce.
 
-    url = 'http://localhost:'+str(port)+'/post_image'
-    files = {'file': open(image, 'rb')}
+    filename     A photo of the event params['event_id'] to send along as
+                 the 'file' field
+    params       A dict of form fields
+    """
+    if ports is None:
+        ports = [port for port in SERVER_LIST if not port == my_port]
+    for port in ports:
+        db.execute('insert into outbound (port, path, filename, params) '
+                   'values (?, ?, ?, ?)',
+                   (port, path, filename, json.dumps(params or {})))
+
+def wake_replicator():
+    start_replicator()
+    replicator_wakeup.set()
+
+def start_replicator():
+    global replicator_thread
+    with replicator_lock:
+        if replicator_thread is None:
+            replicator_thread = threading.Thread(target=replicator_loop)
+            replicator_thread.daemon = True
+            replicator_thread.start()
+
+def deliver_peer_message(port, path, filename, params):
+    """Returns True once the peer has acknowledged the message"""
+    files = None
+    if filename is not None:
+        source = os.path.join(event_folder(params['event_id'], 'images'),
+                              filename)
+        if not os.path.isfile(source):
+            # Published and cleared since; nothing left to send
+            return True
+        files = {'file': (filename, open(source, 'rb'))}
     try:
-        r = requests.post(url, files=files)
+        resp = peer_request(port, 'post', path, data=params, files=files)
     except requests.exceptions.RequestException:
-        flash('Server at port' +str(port)+' is down. Cannot send the image')
-
+        return False
+    finally:
+        if files:
+            files['file'][1].close()
+    return resp.ok
+
+def replicator_loop():
+    db = get_intentions_store()
+    while True:
+        replicator_wakeup.clear()
+        now = time.time()
+        failed_ports = set()
+        rows = db.execute('select id, port, path, filename, params, attempts '
+                          'from outbound where next_attempt <= ? order by id',
+                          (now,)).fetchall()
+        for msg_id, port, path, filename, params, attempts in rows:
+            # Keep the order of messages to a peer that is down
+            if port in failed_ports:
+                continue
+            if deliver_peer_message(port, path, filename, json.loads(params)):
+                with db:
+                    db.execute('delete from outbound where id = ?', (msg_id,))
+                continue
+            failed_ports.add(port)
+            delay = min(app.config['REPLICATION_MAX_DELAY'],
+                        app.config['REPLICATION_RETRY_DELAY'] * 2**attempts)
+            with db:
+                db.execute('update outbound set attempts = ?, next_attempt = ? '
+                           'where port = ? and next_attempt <= ?',
+                           (attempts+1, time.time()+delay, port, now))
+        row = db.execute('select min(next_attempt) from outbound').fetchone()
+        if row[0] is None:
+            replicator_wakeup.wait()
+        else:
+            replicator_wakeup.wait(max(0.05, row[0] - time.time()))
+
+# Timers of all vote rounds, run from a single scheduler thread
+scheduler_cond = threading.Condition()
+scheduler_heap = []
+scheduler_thread = None
+cancelled_timers = set()
+timer_ids = itertools.count()
+
+def schedule(when, fn, *args):
+    """Runs fn(*args) on the scheduler thread at the time when. Returns
+    an id for cancel_timer.
     """
-    for sport in SERVER_LIST:
-        if sport == my_port or sport == master_port:
-            continue
-        url = 'http://localhost:'+str(sport)+'/set_dirty'
+    global scheduler_thread
+    with scheduler_cond:
+        timer_id = next(timer_ids)
+        heapq.heappush(scheduler_heap, (when, timer_id, fn, args))
+        if scheduler_thread is None:
+            scheduler_thread = threading.Thread(target=scheduler_loop)
+            scheduler_thread.daemon = True
+            scheduler_thread.start()
+        scheduler_cond.notify()
+    return timer_id
+
+def cancel_timer(timer_id):
+    with scheduler_cond:
+        cancelled_timers.add(timer_id)
+
+def scheduler_loop():
+    while True:
+        with scheduler_cond:
+            while not scheduler_heap or scheduler_heap[0][0] > time.time():
+                if scheduler_heap:
+                    scheduler_cond.wait(scheduler_heap[0][0] - time.time())
+                else:
+                    scheduler_cond.wait()
+            when, timer_id, fn, args = heapq.heappop(scheduler_heap)
+            if timer_id in cancelled_timers:
+                cancelled_timers.discard(timer_id)
+                continue
         try:
-            requests.post(url)
-        except requests.exceptions.RequestException:
-            flash('Server at port' +str(sport)+' is down. Cannot update dirty flag')
+            fn(*args)
+        except Exception:
+            traceback.print_exc()
+
+# Kinds of transactions that run through prepare and commit/abort
+TXN_KINDS = ('photo', 'event')
+
+def staged_path(txn_id):
+    return os.path.join(app.config['STAGING_FOLDER'], txn_id)
+
+def fsync_file(path):
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+def distribute_event(db, txn_id, event_id, name):
+    """\
+    Creates an event with this site as its coordinator, and its shadow
+    events at every other site with two phase commit. Returns True if it
+    was committed.
+    """
+    create_event_folders(event_id)
+    with db:
+        add_event(db, event_id, name, my_port, 'preparing')
+        log_txn(db, txn_id, 'event', 'coordinator', 'preparing', my_port,
+                event_id=event_id)
+    answers = fan_out_json('/prepare_event',
+                           data={'txn_id': txn_id, 'event_id': event_id,
+                                 'name': name, 'coordinator': my_port})
+    commit = all(answer is not None and answer['vote']
+                 for answer in answers.values())
+    decide_txn(db, txn_id, 'event', commit)
+    return commit
+
+def distribute_photo(db, txn_id, event_id, filename):
+    """\
+    Adds the photo staged for txn_id to an event at every site with two
+    phase commit, as its coordinator. Returns True if it was committed.
+    """
+    fsync_file(staged_path(txn_id))
+    with db:
+        log_txn(db, txn_id, 'photo', 'coordinator', 'preparing', my_port,
+                filename, event_id)
+    answers = fan_out_json('/events/'+event_id+'/prepare_photo',
+                           upload=staged_path(txn_id),
+                           data={'txn_id': txn_id, 'filename': filename,
+                                 'coordinator': my_port})
+    commit = all(answer is not None and answer['vote']
+                 for answer in answers.values())
+    decide_txn(db, txn_id, 'photo', commit)
+    return commit
+
+def decide_txn(db, txn_id, kind, commit):
+    """Logs the coordinator's decision and follows through with it"""
+    with db:
+        log_txn(db, txn_id, kind, 'coordinator',
+                'commit' if commit else 'abort')
+        enqueue_peer_message(db, ('/commit_' if commit else '/abort_') + kind,
+                             params={'txn_id': txn_id})
+    wake_replicator()
+    apply_txn_decision(db, txn_id, kind, commit)
+
+def apply_txn_decision(db, txn_id, kind, commit):
+    """Applies a decision to what was prepared here. Safe to repeat."""
+    txn = get_txn(db, txn_id)
+    if txn is not None and txn['state'] in TXN_DONE:
+        return
+    if kind == 'photo':
+        staged = staged_path(txn_id)
+        if commit and txn is not None:
+            if os.path.isfile(staged):
+                os.rename(staged, os.path.join(
+                    event_folder(txn['event_id'], 'images'), txn['filename']))
+            store_thumbnail(txn['event_id'], txn['filename'])
+        elif os.path.isfile(staged):
+            os.remove(staged)
+    with db:
+        if kind == 'event' and txn is not None:
+            update_event(db, txn['event_id'],
+                         state='active' if commit else 'aborted')
+        # An abort for a transaction never seen here stops a late prepare
+        log_txn(db, txn_id, kind, 'participant',
+                'committed' if commit else 'aborted')
+
+def recover_transactions():
+    """\
+    Finishes what a crash left open. Decisions already logged are applied
+    again, photos and events that were never decided are aborted, vote
+    rounds resume with the time they had left, and in-doubt participants
+    ask their coordinator.
     """
-    return
+    db = get_intentions_store()
+    in_doubt = False
+    for txn in list_open_txns(db):
+        if txn['kind'] in TXN_KINDS and txn['role'] == 'participant':
+            in_doubt = True
+        elif txn['kind'] in TXN_KINDS and txn['state'] == 'preparing':
+            decide_txn(db, txn['txn_id'], txn['kind'], False)
+        elif txn['kind'] in TXN_KINDS:
+            apply_txn_decision(db, txn['txn_id'], txn['kind'],
+                               txn['state'] == 'commit')
+        elif txn['state'] == 'collecting':
+            vote_timers[txn['txn_id']] = schedule(
+                txn['created'] + app.config['VOTE_PERIOD'],
+                collect_votes, txn['txn_id'])
+            check_vote_round(db, txn['txn_id'])
+        else:
+            check_and_commit(txn['event_id'], txn['state'] == 'commit',
+                             txn['txn_id'])
+    if in_doubt:
+        t = threading.Thread(target=resolve_in_doubt)
+        t.daemon = True
+        t.start()
+    # A vote started before the transaction log existed
+    for (event_id,) in db.execute('select event_id from events '
+                                  'where coordinator = ? and cannot_upload = 1',
+                                  (my_port,)).fetchall():
+        if open_vote_txn(db, event_id) is None:
+            start_vote_round(db, event_id)
+
+def resolve_in_doubt():
+    """Asks coordinators about work prepared here until all is decided"""
+    db = get_intentions_store()
+    while True:
+        txns = [txn for txn in list_open_txns(db, role='participant')
+                if txn['kind'] in TXN_KINDS]
+        if not txns:
+            return
+        for txn in txns:
+            try:
+                resp = peer_request(txn['coordinator'], 'get', '/txn_status',
+                                    params={'txn_id': txn['txn_id']})
+                state = resp.json()['state']
+            except (requests.exceptions.RequestException, ValueError):
+                continue
+            # Presumed abort: a coordinator with no record never committed
+            if state in ('commit', 'committed'):
+                apply_txn_decision(db, txn['txn_id'], txn['kind'], True)
+            elif state in ('abort', 'aborted', 'unknown'):
+                apply_txn_decision(db, txn['txn_id'], txn['kind'], False)
+        time.sleep(app.config['RECOVERY_INTERVAL'])
+
+def migrate_legacy_folders():
+    """Moves the files of the single-event layout into the default event"""
+    legacy = [(UPLOAD_FOLDER, 'images'), (THUMBNAIL_FOLDER, 'thumbnails'),
+              (CURMONTAGE_FOLDER, 'curmontage'), (MONTAGE_FOLDER, 'montages')]
+    if not any(os.path.isdir(path) for path, kind in legacy):
+        return
+    db = get_intentions_store()
+    with db:
+        ensure_default_event(db)
+    create_event_folders(DEFAULT_EVENT)
+    for path, kind in legacy:
+        if not os.path.isdir(path):
+            continue
+        for filename in os.listdir(path):
+            os.rename(os.path.join(path, filename),
+                      os.path.join(event_folder(DEFAULT_EVENT, kind), filename))
+        os.rmdir(path)
+    if os.path.isdir(event_folder(DEFAULT_EVENT, 'montages')):
+        with db:
+            for filename in os.listdir(event_folder(DEFAULT_EVENT, 'montages')):
+                version = os.path.splitext(filename)[0]
+                if version.isdigit():
+                    db.execute('insert or ignore into montage_versions '
+                               '(event_id, version, filename, published) '
+                               'values (?, ?, ?, ?)',
+                               (DEFAULT_EVENT, int(version), filename, 0))
 
 def check_and_createdir(path):
     dir = os.path.dirname(path)
@@ -577,13 +1557,20 @@ def check_and_createdir(path):
         os.makedirs(dir)
 
 if __name__ == '__main__':
-    check_and_createdir(app.config['UPLOAD_FOLDER'])
-    check_and_createdir(app.config['MONTAGE_FOLDER'])
-    check_and_createdir(app.config['CURMONTAGE_FOLDER'])
+    check_and_createdir(app.config['EVENTS_FOLDER'])
+    check_and_createdir(app.config['STAGING_FOLDER'])
+    migrate_legacy_folders()
+    # Thumbs for photos uploaded before the thumbnail store existed
+    for event_id in os.listdir(app.config['EVENTS_FOLDER']):
+        if not os.path.isdir(event_folder(event_id, 'images')):
+            continue
+        manifest = read_thumbnail_manifest(event_id)
+        for filename in os.listdir(event_folder(event_id, 'images')):
+            if filename not in manifest:
+                store_thumbnail(event_id, filename)
     global my_port
     global master_port
-    intentions = get_intentions_store()
-    if intentions.has_key('cannot_upload') and my_port == master_port:
-        if intentions['cannot_upload']:
-            threading.Thread(target=collect_votes).start()
-    app.run(host='0.0.0.0', port=my_port)
\ No newline at end of file
+    recover_transactions()
+    start_replicator()
+    # Threaded, so that the dev server speaks HTTP/1.1 keep-alive to peers
+    app.run(host='0.0.0.0', port=my_port, threaded=True)